@@ -1,6 +1,5 @@
 import os
 import sys
-import io
 import uuid
 import json
 import subprocess
@@ -8,19 +7,175 @@ import magic
 import re
 import time
 from tqdm import tqdm
-from PIL import Image
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from datetime import datetime
 import queue
 import concurrent.futures
+import itertools
 import threading
+import selectors
+import atexit
+import shutil
+import functools
+import struct
+import zlib
+import mmap
+import sqlite3
+import contextlib
+import tempfile
+
+def detect_memory_bytes():
+    # Memory actually available to this process: the cgroup (container) limit when one
+    # is set, otherwise physical RAM. None if neither can be read.
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and int(value) < 1 << 60: # "max" / huge sentinel = unlimited
+            return int(value)
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
 
 # Configuration
 INPUT_DIR = '/app/input'
 OUTPUT_DIR = '/app/output'
 LOG_FILE = '/app/output/processing_log.json'
+CACHE_FILE = '/app/output/.sanitizer_cache.db' # Inputs already sanitized by a previous run
 MAX_FILE_SIZE_BYTES = 2 * 1024 * 1024 * 1024 # 2GB
 MAX_IMAGE_PIXELS = 200 * 1000 * 1000 # 200MP
-MAX_WORKERS = 2
+MAX_IMAGE_DIM = int(os.environ.get('SANITIZER_MAX_DIM', 0)) # Optional downscale cap in pixels (0 = keep original size)
+MAX_MEDIA_DURATION = 4 * 3600 # 4 hours (video/audio)
+LOG_FLUSH_INTERVAL = 1.0 # Max seconds buffered log entries wait before being flushed
+LOG_FLUSH_ENTRIES = 100 # ...or flush once this many entries are pending, whichever comes first
+MIME_HEADER_BYTES = 64 * 1024 # Bytes read for MIME detection
+PREFETCH_BYTES = 64 * 1024 * 1024 # Readahead hint for the head of each ffmpeg input
+PBAR_MIN_INTERVAL = 0.5 # Seconds between progress bar redraws
+STDERR_TAIL_LINES = 200 # ffmpeg stderr lines kept for error reports
+STDERR_TAIL_BYTES = 64 * 1024 # Byte bound on the stderr kept while ffmpeg runs (covers STDERR_TAIL_LINES typical lines)
+PNG_COMPRESS_LEVEL = int(os.environ.get('SANITIZER_PNG_LEVEL', 1)) # zlib level for PNG output (1 = fastest, 9 = smallest + optimize)
+WEBP_QUALITY = 90 # Same target as JPEG output (Pillow defaults to 80)
+WEBP_METHOD = int(os.environ.get('SANITIZER_WEBP_METHOD', 4)) # libwebp effort (0 = fastest, 6 = smallest)
+FFMPEG_PROGRESS_RE = re.compile(rb"^out_time_us=(\d+)$", re.M) # Position in ffmpeg's -progress output (microseconds)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_KEEP_CHUNKS = frozenset({b'IHDR', b'PLTE', b'tRNS', b'IDAT', b'IEND'}) # Everything else (text, eXIf, iCCP, private...) is dropped
+JPEG_KEEP_MARKERS = frozenset({0xC4, 0xCC, 0xDB, 0xDD}) # DHT, DAC, DQT, DRI (SOFn/SOS/APP14 handled separately)
+JPEG_SOF_MARKERS = frozenset({0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF})
+LOG_EVENT_TYPES = frozenset({"SYSTEM", "INFO", "SUCCESS", "ERROR", "SECURITY", "WARNING", "SKIP"})
+AV_EXTS = frozenset({'.mp4', '.m4v', '.mov', '.mkv', '.webm', '.avi', '.wmv', '.flv', '.mpg', '.mpeg', '.ts', '.3gp',
+                     '.mp3', '.m4a', '.aac', '.wav', '.flac', '.ogg', '.oga', '.opus', '.wma', '.gif'}) # Scheduling hint only, MIME still decides
+EXT_MIME = {
+    '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.png': 'image/png', '.webp': 'image/webp', '.bmp': 'image/bmp',
+    '.gif': 'image/gif',
+    '.mp4': 'video/mp4', '.mkv': 'video/x-matroska', '.mov': 'video/quicktime', '.webm': 'video/webm',
+    '.mp3': 'audio/mpeg', '.m4a': 'audio/mp4', '.wav': 'audio/wav', '.flac': 'audio/flac', '.ogg': 'audio/ogg',
+} # Used only with TRUST_EXT; the decoders still reject content that doesn't match
+MIME_TYPE_RE = re.compile(r"^[\w.+-]+/[\w.+-]+$") # Sanity check for `file --mime-type` output lines
+UNSAFE_NAME_RE = re.compile(r'[^a-zA-Z0-9._-]') # Output file names keep only these characters
+SAFE_IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.webp'}) # Kept as-is on output, others (BMP, TIFF...) become .png
+PNG_SAVE_MODES = frozenset({'1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'}) # Pillow modes the PNG encoder accepts
+CPU_COUNT = os.cpu_count() or 2
+MEMORY_BYTES = detect_memory_bytes()
+IMAGE_WORKER_MEMORY = 1024 * 1024 * 1024 # Worst case per Pillow decode at MAX_IMAGE_PIXELS (RGBA + encode buffers)
+# Image pool: one decode per core, but no more than half the memory budget allows
+# (the rest is left for ffmpeg and the interpreter) so a batch of huge images can't OOM the run
+DEFAULT_IMAGE_WORKERS = CPU_COUNT if MEMORY_BYTES is None else max(1, min(CPU_COUNT, MEMORY_BYTES // 2 // IMAGE_WORKER_MEMORY))
+MAX_WORKERS = max(1, int(os.environ.get('SANITIZER_MAX_WORKERS', DEFAULT_IMAGE_WORKERS))) # Image pool
+AV_WORKERS = max(1, int(os.environ.get('SANITIZER_AV_WORKERS', CPU_COUNT // 4))) # Media pool (each ffmpeg is multi-threaded itself)
+IMAGE_BAR_SLOTS = min(MAX_WORKERS, 2) # Bar rows for image workers (they only draw one for misnamed media)
+FFMPEG_THREADS = max(2, CPU_COUNT // AV_WORKERS) # Per-ffmpeg cap so parallel workers don't oversubscribe
+X264_PRESET = os.environ.get('SANITIZER_X264_PRESET', 'veryfast') # Speed over archival quality
+FAST_COPY = os.environ.get('SANITIZER_FAST_COPY') == '1' # Opt-in: remux H.264/AAC video, AAC audio and PNG/JPEG/GIF without re-encoding
+USE_CACHE = os.environ.get('SANITIZER_CACHE', '1') == '1' # Skip inputs unchanged (size + mtime) since their last successful run
+TRUST_EXT = os.environ.get('SANITIZER_TRUST_EXT') == '1' # Opt-in: take the MIME type of well-known extensions without reading the file
+GIF_TO_MP4 = os.environ.get('SANITIZER_GIF_TO_MP4') == '1' # Opt-in: animated GIFs become (much smaller) silent H.264 MP4s
+HW_ENCODE = os.environ.get('SANITIZER_HW_ENCODE', '1') == '1' # Use a GPU H.264 encoder when one actually works
+# Settings that change what an output looks like; cached outputs made under different ones are redone
+CACHE_VERSION = 2 # Bump whenever sanitizing behaviour changes, so outputs from older builds are redone
+CACHE_SETTINGS = repr((CACHE_VERSION, FAST_COPY, MAX_IMAGE_DIM, GIF_TO_MP4, X264_PRESET, HW_ENCODE, PNG_COMPRESS_LEVEL,
+                       WEBP_QUALITY, WEBP_METHOD, MAX_IMAGE_PIXELS, MAX_MEDIA_DURATION))
+
+GIFSICLE = shutil.which('gifsicle') # Fast metadata-only GIF rewrite (FAST_COPY only) when installed
+FILE_CMD = shutil.which('file') # Batch MIME detection up front (libmagic per file otherwise)
+
+# Hardware H.264 encoders in order of preference, with their encoder options
+# (quality targets roughly matching libx264 CRF 23)
+HW_ENCODERS = [
+    ('h264_nvenc', ['-preset', 'p4', '-tune', 'hq', '-rc', 'vbr', '-cq', '23', '-b:v', '0']),
+    ('h264_qsv', ['-preset', 'veryfast', '-global_quality', '23']),
+    ('h264_videotoolbox', ['-q:v', '65']),
+]
+SOFTWARE_ENCODER = ('libx264', ['-preset', X264_PRESET, '-crf', '23'])
+
+# FFmpeg resource caps (the video/audio analogue of MAX_IMAGE_PIXELS)
+# Input side: bound how much data is buffered while probing, and decoder threads
+FFMPEG_INPUT_LIMITS = (
+    '-analyzeduration', '5M',
+    '-probesize', '5M',
+    '-threads', str(FFMPEG_THREADS),
+)
+# Output side: bound the muxing queue, encoder threads and output length
+FFMPEG_OUTPUT_LIMITS = (
+    '-max_muxing_queue_size', '1024',
+    '-threads', str(FFMPEG_THREADS),
+    '-t', str(MAX_MEDIA_DURATION),
+)
+
+# Prebuilt ffmpeg argument groups: per call only the paths (and video encoder) change
+# Progress goes to stdout as key=value blocks (see run_ffmpeg); -nostats keeps stderr for real messages
+FFMPEG_CMD_PREFIX = ('ffmpeg', '-y', '-nostdin', '-nostats', '-progress', 'pipe:1', *FFMPEG_INPUT_LIMITS)
+VIDEO_MAP_ARGS = (
+    '-map', '0:v:0',
+    '-map', '0:a:0?',
+    '-map_metadata', '-1',
+    '-map_chapters', '-1',
+)
+VIDEO_REMUX_ARGS = ('-c:v', 'copy', '-c:a', 'copy')
+# yuv420p keeps the output playable everywhere (4:4:4/10-bit inputs would otherwise
+# produce High 4:4:4 profile streams many players reject)
+VIDEO_TRANSCODE_ARGS = ('-pix_fmt', 'yuv420p', '-c:a', 'aac', '-b:a', '128k')
+# moov atom up front so playback can start before full download
+VIDEO_OUTPUT_ARGS = ('-movflags', '+faststart', *FFMPEG_OUTPUT_LIMITS)
+AUDIO_MAP_ARGS = (
+    '-map', '0:a:0',       # Pick first audio stream
+    '-map_metadata', '-1', # Strip metadata
+)
+AUDIO_REMUX_ARGS = ('-c:a', 'copy') # Already AAC: just rewrap without metadata
+AUDIO_TRANSCODE_ARGS = (
+    '-c:a', 'aac',         # Re-encode Audio to AAC
+    '-b:a', '192k',        # Good quality bitrate
+)
+AUDIO_OUTPUT_ARGS = ('-movflags', '+faststart', *FFMPEG_OUTPUT_LIMITS)
+GIF_INPUT_ARGS = ('-fflags', '+discardcorrupt')
+# Two passes instead of split+palettegen in one graph: that buffers every decoded frame
+# until the palette is ready, so memory would grow with the animation's length
+GIF_PALETTE_ARGS = (
+    '-map', '0:v:0',
+    '-vf', 'palettegen=stats_mode=diff',
+    '-update', '1',
+    *FFMPEG_OUTPUT_LIMITS,
+)
+GIF_OUTPUT_ARGS = (
+    '-filter_complex', '[0:v:0][1:v]paletteuse=dither=sierra2_4a',
+    '-map_metadata', '-1',
+    '-f', 'gif',
+    *FFMPEG_OUTPUT_LIMITS,
+)
+GIF_MP4_ARGS = (
+    '-map', '0:v:0',
+    '-map_metadata', '-1',
+    '-an',
+    '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', # yuv420p needs even dimensions
+    '-pix_fmt', 'yuv420p',
+    '-c:v', SOFTWARE_ENCODER[0], *SOFTWARE_ENCODER[1],
+    *VIDEO_OUTPUT_ARGS,
+)
 
 # Statistics Tracking
 stats = {
@@ -43,8 +198,30 @@ stats = {
 }
 stats_lock = threading.Lock()
 
-# Safety: Prevent decompression bombs
-Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+# Cached (encoder, options) for video transcodes, resolved on first use
+_video_encoder = None
+encoder_lock = threading.Lock()
+
+# Log file writer: workers only enqueue entries; a single background thread
+# serializes them to a persistent buffered handle (opened once in main)
+_LOG_FH = None
+_LOG_Q = queue.Queue()
+_cache = {} # rel_path -> (size, mtime, output_path, category, settings) from previous runs, read-only during the run
+_cache_updates = [] # Rows for this run's successes, written in one transaction at the end (guarded by stats_lock)
+_log_writer = None
+
+# One libmagic detector per worker thread: the database is loaded once per thread, and
+# workers don't contend on python-magic's internal lock
+_mime_local = threading.local()
+_worker_local = threading.local() # Per-worker tqdm slot, assigned once in init_worker
+
+@functools.lru_cache(maxsize=None)
+def load_pil():
+    # Pillow is only imported once an image actually needs processing (video/audio-only runs skip it)
+    from PIL import Image
+    # Safety: Prevent decompression bombs
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    return Image
 
 def format_size(bytes):
     for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
@@ -54,11 +231,11 @@ def format_size(bytes):
     return f"{bytes:.2f} PB"
 
 def log_event(event_type, message, file_info=None):
-    valid_types = ["SYSTEM", "INFO", "SUCCESS", "ERROR", "SECURITY", "WARNING", "SKIP"]
-    if event_type not in valid_types:
+    if event_type not in LOG_EVENT_TYPES:
         event_type = "INFO"
 
-    timestamp = datetime.now().isoformat()
+    now = datetime.now()
+    timestamp = now.isoformat()
     entry = {
         "timestamp": timestamp,
         "type": event_type,
@@ -68,7 +245,7 @@ def log_event(event_type, message, file_info=None):
 
     # Console Output (Human Readable)
     # Format: [HH:MM:SS] [TYPE] Message (Extra Info)
-    time_str = datetime.now().strftime("%H:%M:%S")
+    time_str = now.strftime("%H:%M:%S")
     console_msg = f"[{time_str}] [{event_type}] {message}"
     
     if file_info:
@@ -83,62 +260,440 @@ def log_event(event_type, message, file_info=None):
     # Use tqdm.write to avoid interfering with progress bars
     tqdm.write(console_msg)
 
-    # Append to log file
+    # Hand off to the log writer thread (no file I/O on the worker's path)
+    if _log_writer is not None:
+        _LOG_Q.put(entry)
+
+def serialize_log_entry(entry):
+    # orjson is much faster and emits bytes directly; stdlib json is the fallback
+    # (also for paths with surrogate escapes, which orjson rejects)
+    if orjson is not None:
+        try:
+            return orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            pass
+    return (json.dumps(entry) + '\n').encode('utf-8')
+
+def log_writer_loop():
+    # Flushes every LOG_FLUSH_ENTRIES entries or LOG_FLUSH_INTERVAL seconds (also while
+    # entries keep arriving), so a killed container loses at most that much of the log
+    pending = 0
+    last_flush = time.monotonic()
+    while True:
+        try:
+            entry = _LOG_Q.get(timeout=LOG_FLUSH_INTERVAL)
+        except queue.Empty:
+            entry = False # Idle: just check whether buffered lines are due
+
+        if entry is None: # Shutdown sentinel
+            break
+        if entry:
+            try:
+                _LOG_FH.write(serialize_log_entry(entry))
+                pending += 1
+            except Exception as e:
+                # tqdm.write(f"FATAL: Could not write to log file: {e}")
+                pass
+
+        if pending and (pending >= LOG_FLUSH_ENTRIES or time.monotonic() - last_flush >= LOG_FLUSH_INTERVAL):
+            try: _LOG_FH.flush()
+            except: pass
+            pending = 0
+            last_flush = time.monotonic()
+
+def open_log():
+    global _LOG_FH, _log_writer
     try:
-        with open(LOG_FILE, 'a') as f:
-            f.write(json.dumps(entry) + '\n')
+        _LOG_FH = open(LOG_FILE, 'ab', buffering=1 << 16)
     except Exception as e:
-        # tqdm.write(f"FATAL: Could not write to log file: {e}")
-        pass
+        tqdm.write(f"WARNING: Could not open log file: {e}")
+        return
+    _log_writer = threading.Thread(target=log_writer_loop, name="log-writer", daemon=True)
+    _log_writer.start()
+    atexit.register(close_log)
+
+def close_log():
+    global _LOG_FH, _log_writer
+    if _log_writer is None:
+        return
+    # Drain everything queued so far, then close the file
+    _LOG_Q.put(None)
+    _log_writer.join()
+    _log_writer = None
+    try: _LOG_FH.close()
+    except: pass
+    _LOG_FH = None
+
+def get_mime_detector():
+    detector = getattr(_mime_local, 'detector', None)
+    if detector is None:
+        detector = magic.Magic(mime=True)
+        _mime_local.detector = detector
+    return detector
 
 def get_mime_type(filepath):
     try:
-        mime = magic.Magic(mime=True)
-        return mime.from_file(filepath)
+        # Classify from one bounded header read instead of letting libmagic open the
+        # file itself and scan up to its own (multi-MB) read limit
+        with open(filepath, 'rb') as f:
+            header = f.read(MIME_HEADER_BYTES)
+        return get_mime_detector().from_buffer(header)
     except Exception as e:
         log_event("ERROR", f"Failed to detect MIME type: {e}")
         return None
 
-def get_video_duration(input_path):
+def load_cache():
+    if not USE_CACHE:
+        return {}
+    try:
+        with contextlib.closing(sqlite3.connect(CACHE_FILE)) as db:
+            # Caches from before the settings column was added are simply discarded
+            columns = [row[1] for row in db.execute("PRAGMA table_info(files)")]
+            if columns and 'settings' not in columns:
+                db.execute("DROP TABLE files")
+            # Paths are stored as BLOBs (os.fsencode) so non-UTF-8 file names can be bound
+            db.execute("CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, size INTEGER, mtime REAL, output BLOB, category TEXT, settings TEXT)")
+            return {os.fsdecode(path): (size, mtime, os.fsdecode(output), category, settings)
+                    for path, size, mtime, output, category, settings
+                    in db.execute("SELECT path, size, mtime, output, category, settings FROM files")}
+    except (sqlite3.Error, ValueError) as e:
+        log_event("WARNING", f"Could not read cache: {e}")
+        return {}
+
+def save_cache(rows):
+    if not USE_CACHE or not rows:
+        return
+    try:
+        with contextlib.closing(sqlite3.connect(CACHE_FILE)) as db:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                               [(os.fsencode(path), size, mtime, os.fsencode(output), category, CACHE_SETTINGS)
+                                for path, size, mtime, output, category in rows])
+    except (sqlite3.Error, ValueError) as e:
+        log_event("WARNING", f"Could not write cache: {e}")
+
+def cached_entry(rel_path, size, mtime):
+    # (output_path, category) when the input is unchanged since it was last sanitized
+    # with the same settings (e.g. a FAST_COPY remux doesn't satisfy a default run)
+    entry = _cache.get(rel_path)
+    if entry and entry[0] == size and entry[1] == mtime and entry[4] == CACHE_SETTINGS:
+        return entry[2], entry[3]
+    return None
+
+def detect_mime_types(rel_paths):
+    # One `file` run over every input instead of a libmagic pass per worker call.
+    # -b prints one line per path in input order, so nothing is parsed out of
+    # (attacker-chosen) file names. Returns {rel_path: mime}; anything missing or odd
+    # falls back to get_mime_type() in process_file.
+    if not FILE_CMD:
+        return {}
+    # --files-from is newline separated, so names containing one are left to the fallback.
+    # Paths go over as bytes (os.fsencode) so non-UTF-8 names round-trip unchanged.
+    paths = [p for p in rel_paths if '\n' not in p]
+    if not paths:
+        return {}
+    cmd = [FILE_CMD, '-b', '-L', '--mime-type', '-P', f'bytes={MIME_HEADER_BYTES}', '--files-from', '-']
+    try:
+        result = subprocess.run(cmd, input=b''.join(os.fsencode(os.path.join(INPUT_DIR, p)) + b'\n' for p in paths),
+                                capture_output=True, timeout=600)
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        log_event("WARNING", f"Batch MIME detection failed: {e}")
+        return {}
+    lines = result.stdout.decode('utf-8', errors='replace').splitlines()
+    if result.returncode != 0 or len(lines) != len(paths):
+        log_event("WARNING", "Batch MIME detection failed - Falling back to per-file detection")
+        return {}
+    return {p: line.strip() for p, line in zip(paths, lines) if MIME_TYPE_RE.match(line.strip())}
+
+def probe_media(input_path):
+    # One ffprobe run per file: returns (duration, video_codec, audio_codec), None where unknown/absent
     cmd = [
-        'ffprobe', 
-        '-v', 'error', 
-        '-show_entries', 'format=duration', 
-        '-of', 'default=noprint_wrappers=1:nokey=1', 
+        'ffprobe',
+        '-v', 'error',
+        '-show_entries', 'format=duration:stream=codec_type,codec_name',
+        '-of', 'json',
         input_path
     ]
     try:
         result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace', timeout=10)
-        return float(result.stdout.strip())
-    except (ValueError, subprocess.SubprocessError):
-        return None
+        info = json.loads(result.stdout)
+        streams = info.get('streams', [])
+        fmt = info.get('format', {})
+    except (ValueError, AttributeError, subprocess.SubprocessError):
+        return None, None, None
+
+    try:
+        duration = float(fmt.get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+    video_codec = next((s.get('codec_name') for s in streams if s.get('codec_type') == 'video'), None)
+    audio_codec = next((s.get('codec_name') for s in streams if s.get('codec_type') == 'audio'), None)
+    return duration, video_codec, audio_codec
+
+def get_video_encoder():
+    global _video_encoder
+    with encoder_lock:
+        if _video_encoder is not None:
+            return _video_encoder
+
+        _video_encoder = SOFTWARE_ENCODER
+        if not HW_ENCODE:
+            return _video_encoder
+
+        try:
+            result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace', timeout=10)
+            available = result.stdout
+        except subprocess.SubprocessError:
+            return _video_encoder
+
+        for name, options in HW_ENCODERS:
+            if name not in available:
+                continue
+            # Being compiled in doesn't mean the device is reachable (e.g. no GPU in the container),
+            # so confirm with a one-frame test encode before trusting it.
+            test_cmd = [
+                'ffmpeg', '-hide_banner', '-nostdin', '-v', 'error',
+                '-f', 'lavfi', '-i', 'color=black:size=256x256',
+                '-frames:v', '1',
+                '-c:v', name, *options,
+                '-f', 'null', '-'
+            ]
+            try:
+                if subprocess.run(test_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15).returncode == 0:
+                    _video_encoder = (name, options)
+                    log_event("SYSTEM", f"Using hardware video encoder: {name}")
+                    break
+            except subprocess.SubprocessError:
+                continue
+
+        return _video_encoder
+
+def strip_png_chunks(input_path, output_path):
+    # Level 1 (Remux) for PNG: rewrite the container keeping only the chunks needed to
+    # render the image. Pixel data is copied bit-exact without a decode/encode.
+    # Returns False (caller falls back to the Pillow path) for anything that isn't a
+    # well-formed PNG: bad signature/CRC, unexpected chunk order, oversized dimensions.
+    try:
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            if src.read(8) != PNG_SIGNATURE:
+                raise ValueError("not a PNG")
+            dst.write(PNG_SIGNATURE)
+
+            first = True
+            color_type = None
+            seen_plte = False
+            idat_state = 0 # 0 = no IDAT yet, 1 = inside the IDAT run, 2 = run ended
+            while True:
+                header = src.read(8)
+                if len(header) != 8:
+                    raise ValueError("truncated chunk header")
+                length, chunk_type = struct.unpack('>I4s', header)
+                if length > 0x7FFFFFFF:
+                    raise ValueError("invalid chunk length")
+                if first:
+                    if chunk_type != b'IHDR' or length != 13:
+                        raise ValueError("IHDR must come first")
+                    first = False
+                elif chunk_type == b'IHDR':
+                    raise ValueError("duplicate IHDR")
+
+                # Chunk order the decoders rely on: PLTE/tRNS before the image data, IDAT
+                # chunks consecutive, and at least one IDAT before IEND
+                if chunk_type == b'IDAT':
+                    if idat_state == 2:
+                        raise ValueError("IDAT chunks not consecutive")
+                    if color_type == 3 and not seen_plte:
+                        raise ValueError("indexed image without PLTE")
+                    idat_state = 1
+                else:
+                    if idat_state == 1:
+                        idat_state = 2
+                    if chunk_type in (b'PLTE', b'tRNS') and idat_state:
+                        raise ValueError(f"{chunk_type.decode()} after image data")
+                    if chunk_type == b'PLTE':
+                        if seen_plte:
+                            raise ValueError("duplicate PLTE")
+                        seen_plte = True
+                    if chunk_type == b'IEND' and not idat_state:
+                        raise ValueError("no image data")
+
+                keep = chunk_type in PNG_KEEP_CHUNKS
+                if keep:
+                    dst.write(header)
+
+                # Stream the chunk data through in pieces so a huge IDAT doesn't sit in memory
+                crc = zlib.crc32(chunk_type)
+                remaining = length
+                while remaining:
+                    data = src.read(min(remaining, 1 << 20))
+                    if not data:
+                        raise ValueError("truncated chunk data")
+                    if chunk_type == b'IHDR':
+                        width, height = struct.unpack('>II', data[:8])
+                        color_type = data[9]
+                        if width * height > MAX_IMAGE_PIXELS:
+                            raise ValueError("image dimensions exceed limit")
+                    crc = zlib.crc32(data, crc)
+                    remaining -= len(data)
+                    if keep:
+                        dst.write(data)
+
+                crc_bytes = src.read(4)
+                if len(crc_bytes) != 4 or struct.unpack('>I', crc_bytes)[0] != crc:
+                    raise ValueError("chunk CRC mismatch")
+                if keep:
+                    dst.write(crc_bytes)
+
+                # Anything after IEND (appended payloads, polyglot tails) is never copied
+                if chunk_type == b'IEND':
+                    return True
+    except (OSError, ValueError, struct.error):
+        remove_partial_output(output_path)
+        return False
+
+def strip_jpeg_segments(input_path, output_path):
+    # Level 1 (Remux) for JPEG: rewrite the marker stream keeping only the tables, frame
+    # header and scans. The entropy-coded data is copied as-is, so there is no DCT
+    # decode/encode and no generation loss. APPn (Exif, XMP, ICC, Photoshop, JFIF
+    # thumbnails) and COM segments are dropped; the Adobe APP14 color transform flag is
+    # kept since CMYK/RGB files decode wrongly without it.
+    # Returns False (caller falls back to the Pillow path) for anything unexpected.
+    try:
+        with open(input_path, 'rb') as src, open(output_path, 'wb') as dst:
+            # mmap: scans are searched for the next marker without reading the file into memory
+            with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:2] != b'\xff\xd8':
+                    raise ValueError("not a JPEG")
+                dst.write(b'\xff\xd8')
+
+                size = len(data)
+                pos = 2
+                have_frame = False
+                while True:
+                    if pos + 2 > size or data[pos] != 0xFF:
+                        raise ValueError("expected marker")
+                    # Markers may be preceded by any number of 0xFF fill bytes
+                    while pos + 1 < size and data[pos + 1] == 0xFF:
+                        pos += 1
+                    if pos + 2 > size:
+                        raise ValueError("truncated marker")
+                    marker = data[pos + 1]
+
+                    # Anything after EOI (appended payloads, polyglot tails) is never copied
+                    if marker == 0xD9:
+                        if not have_frame:
+                            raise ValueError("no frame header")
+                        dst.write(b'\xff\xd9')
+                        return True
+
+                    if pos + 4 > size:
+                        raise ValueError("truncated segment header")
+                    length = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+                    end = pos + 2 + length
+                    if length < 2 or end > size:
+                        raise ValueError("invalid segment length")
+                    segment = data[pos:end]
+
+                    if marker in JPEG_SOF_MARKERS:
+                        if have_frame or length < 8:
+                            raise ValueError("invalid frame header")
+                        height, width = struct.unpack('>HH', segment[5:9])
+                        if width * height > MAX_IMAGE_PIXELS:
+                            raise ValueError("image dimensions exceed limit")
+                        have_frame = True
+                        dst.write(segment)
+                    elif marker in JPEG_KEEP_MARKERS:
+                        dst.write(segment)
+                    elif marker == 0xEE:
+                        # Adobe APP14 is a fixed 12-byte payload; anything longer carries extra data
+                        if length == 14 and segment[4:9] == b'Adobe':
+                            dst.write(segment)
+                    elif marker == 0xDA:
+                        if not have_frame:
+                            raise ValueError("scan before frame header")
+                        # Entropy-coded data runs until the next marker that isn't byte
+                        # stuffing (FF00), a restart marker (FFD0-FFD7) or fill (FFFF)
+                        scan = end
+                        while True:
+                            scan = data.find(b'\xff', scan)
+                            if scan < 0 or scan + 1 >= size:
+                                raise ValueError("truncated scan")
+                            following = data[scan + 1]
+                            if following == 0x00 or 0xD0 <= following <= 0xD7:
+                                scan += 2
+                            elif following == 0xFF:
+                                scan += 1
+                            else:
+                                break
+                        # Copied in bounded pieces: one slice of a multi-GB scan would be a full copy
+                        for piece in range(pos, scan, 1 << 20):
+                            dst.write(data[piece:min(piece + (1 << 20), scan)])
+                        end = scan
+                    elif not (0xE0 <= marker <= 0xEF or marker == 0xFE):
+                        # SOI again, DNL, DHP, JPG extensions, reserved... not worth trusting
+                        raise ValueError(f"unexpected marker 0x{marker:02X}")
+
+                    pos = end
+    except (OSError, ValueError, struct.error):
+        remove_partial_output(output_path)
+        return False
 
 def sanitize_image(input_path, output_path):
+    if FAST_COPY and not MAX_IMAGE_DIM:
+        # Pick the container rewrite from the output extension (kept from the input);
+        # a mislabeled file simply fails its signature check and takes the Pillow path
+        ext = os.path.splitext(output_path)[1]
+        if ext == '.png' and strip_png_chunks(input_path, output_path):
+            log_event("SUCCESS", "Image sanitized successfully (PNG chunk strip)", {"input": input_path, "output": output_path})
+            return True
+        if ext in ('.jpg', '.jpeg') and strip_jpeg_segments(input_path, output_path):
+            log_event("SUCCESS", "Image sanitized successfully (JPEG segment strip)", {"input": input_path, "output": output_path})
+            return True
+
+    Image = load_pil()
     try:
         # Open the image
         with Image.open(input_path) as img:
             # Handle format-specific logic
             output_format = img.format if img.format else 'PNG'
+            # Multi-picture camera JPEGs (MPF previews): Pillow calls them MPO, but the
+            # primary image is a plain JPEG and the file keeps its .jpg name. Only that
+            # first frame is written back, so the embedded previews are dropped too.
+            if output_format == 'MPO':
+                output_format = 'JPEG'
             
             # Reconstruction Strategy:
-            # We create a new image (=new container) and copy PIXELS only.
-            # This implicitly drops Exif, ICC profiles, and unknown chunks.
-            
-            # Force full data read
-            data = img.getdata()
-            clean_img = Image.new(img.mode, img.size)
-            clean_img.putdata(data)
+            # Decode the raster, then re-encode it into a brand new file (=new container).
+            # Clearing img.info and passing empty exif/icc ensures no Exif, ICC profiles,
+            # XMP, comments or unknown chunks are carried over into the output.
+            if MAX_IMAGE_DIM and max(img.size) > MAX_IMAGE_DIM:
+                # JPEG: let libjpeg downscale in the DCT domain while decoding (1/2, 1/4, 1/8)
+                # instead of decoding full size first. No-op for other formats.
+                if output_format == 'JPEG':
+                    img.draft(None, (MAX_IMAGE_DIM, MAX_IMAGE_DIM))
+                img.load()
+                img.thumbnail((MAX_IMAGE_DIM, MAX_IMAGE_DIM))
+            img.load()
+            img.info = {}
             
             # Determine output extension based on format
             # Using the original (safe) format is better for size/quality
             if output_format == 'JPEG':
-                # exif=b"" ensures we don't accidentally copy any info (though clean_img shouldn't have any)
-                clean_img.save(output_path, format='JPEG', quality=90, optimize=True, exif=b"")
+                # Progressive scans are usually a few percent smaller than baseline
+                img.save(output_path, format='JPEG', quality=90, optimize=True, progressive=True, exif=b"", icc_profile=None)
             elif output_format == 'GIF':
                  # Static GIF (First frame only) - Animations should go to sanitize_gif via FFmpeg
-                 clean_img.save(output_path, format='GIF', save_all=False, exif=b"")
+                 img.save(output_path, format='GIF', save_all=False, exif=b"")
+            elif output_format == 'WEBP':
+                img.save(output_path, format='WEBP', quality=WEBP_QUALITY, method=WEBP_METHOD, exif=b"", icc_profile=None)
             else:
-                clean_img.save(output_path, format=output_format, exif=b"")
+                # PNG, and everything else (BMP, TIFF...) which process_file names .png:
+                # uncompressed/odd containers are rewritten as PNG rather than in their own format
+                if img.mode not in PNG_SAVE_MODES:
+                    img = img.convert('RGBA' if 'A' in img.getbands() else 'RGB')
+                # Fast deflate by default: much cheaper than level 6 for a modest size increase
+                img.save(output_path, format='PNG', compress_level=PNG_COMPRESS_LEVEL,
+                         optimize=PNG_COMPRESS_LEVEL >= 9, exif=b"", icc_profile=None)
                 
             log_event("SUCCESS", "Image sanitized successfully", {"input": input_path, "output": output_path})
             return True
@@ -146,156 +701,232 @@ def sanitize_image(input_path, output_path):
         log_event("ERROR", f"Image sanitization failed: {e}", {"file": input_path})
         return False
 
-def sanitize_video(input_path, output_path, pbar_pos=0):
+def advise_input(input_path, prefetch):
+    # Page cache hints for an ffmpeg input (Unix only; purely advisory, errors ignored)
+    if not hasattr(os, 'posix_fadvise'):
+        return
     try:
-        cmd = [
-            'ffmpeg', '-y', '-nostdin',
-            '-i', input_path,
-            '-map', '0:v:0',
-            '-map', '0:a:0?',
-            '-map_metadata', '-1',
-            '-map_chapters', '-1',
-            '-c:v', 'libx264',
-            '-preset', 'medium',
-            '-crf', '23',
-            '-c:a', 'aac',
-            output_path
-        ]
-        
-        duration = get_video_duration(input_path)
-        # Read as binary to avoid decoding errors from garbage metadata
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        
-        # Wrap stderr to handle text decoding safely with errors='ignore' and universal newlines
-        # this ensures we catch \r updates from ffmpeg and don't crash on bad chars
-        stderr_reader = io.TextIOWrapper(process.stderr, encoding='utf-8', errors='ignore', newline="")
-
-        filename = os.path.basename(input_path)
-        pbar = None
-        if duration:
-            pbar = tqdm(total=duration, unit="s", desc=f"Video ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
+        fd = os.open(input_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        if prefetch:
+            # Start readahead now so disk reads overlap with ffmpeg's startup and first frames
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
         else:
-            pbar = tqdm(unit="s", desc=f"Video ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
+            # Input won't be read again: don't let a batch run evict more useful cache
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def run_ffmpeg(cmd, duration, timeout_limit, desc, pbar_pos=0, input_path=None, leave=True):
+    # Runs ffmpeg, driving a progress bar from its -progress output on stdout.
+    # Returns (returncode, stderr_text); returncode is None if the timeout was hit (process killed).
+    # stderr_text holds only the last STDERR_TAIL_LINES lines.
+    if input_path:
+        advise_input(input_path, prefetch=True)
+
+    # No duration means no progress bar to drive: -progress output goes straight to
+    # /dev/null in the kernel instead of waking this thread twice a second
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE if duration else subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    # Bounded: only the tail matters for error reports. With -nostats stderr carries
+    # log messages only, so it is kept as raw bytes (reads don't line up with lines)
+    # and split into lines once at the end.
+    stderr_tail = bytearray()
+    stderr_trimmed = False
+    progress_pending = b""
+
+    def stderr_text():
+        lines = bytes(stderr_tail[-STDERR_TAIL_BYTES:]).splitlines()
+        if (stderr_trimmed or len(stderr_tail) > STDERR_TAIL_BYTES) and lines:
+            lines = lines[1:] # Cut mid-line by the byte bound
+        lines = [line for line in lines if line]
+        return b"\n".join(lines[-STDERR_TAIL_LINES:]).decode('utf-8', errors='ignore')
+
+    # Throttled: tqdm redraws at most every PBAR_MIN_INTERVAL seconds however often ffmpeg reports
+    pbar_options = dict(unit="s", desc=desc, ncols=80, leave=leave, position=pbar_pos,
+                        mininterval=PBAR_MIN_INTERVAL, miniters=1, smoothing=0.3)
+    if duration:
+        pbar = tqdm(total=duration, **pbar_options)
+    else:
+        pbar = tqdm(**pbar_options)
+
+    deadline = time.monotonic() + timeout_limit
+
+    # Wait on both pipes with select() instead of a blocking readline(): the thread sleeps in
+    # the kernel between ffmpeg updates, and the timeout fires even if ffmpeg goes silent.
+    selector = selectors.DefaultSelector()
+    if duration:
+        selector.register(process.stdout, selectors.EVENT_READ)
+    selector.register(process.stderr, selectors.EVENT_READ)
+
+    try:
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                process.kill()
+                process.wait()
+                return None, stderr_text()
+
+            for key, _ in selector.select(timeout=remaining):
+                chunk = os.read(key.fd, 65536)
+                if not chunk:
+                    selector.unregister(key.fileobj) # EOF: ffmpeg closed the pipe (exiting)
+                    continue
+
+                if key.fileobj is process.stderr:
+                    stderr_tail += chunk
+                    # Trim only once it's twice the bound, so the copy is amortized
+                    if len(stderr_tail) > 2 * STDERR_TAIL_BYTES:
+                        del stderr_tail[:-STDERR_TAIL_BYTES]
+                        stderr_trimmed = True
+                    continue
+
+                # -progress: key=value blocks (~2 per second); only the last complete
+                # out_time_us in this read matters
+                data, _, progress_pending = (progress_pending + chunk).rpartition(b"\n")
+                positions = FFMPEG_PROGRESS_RE.findall(data)
+                if positions:
+                    current_seconds = int(positions[-1]) / 1_000_000
+                    pbar.update(min(current_seconds, duration) - pbar.n)
+
+        try:
+            process.wait(timeout=max(0, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            return None, stderr_text()
+        return process.returncode, stderr_text()
+    finally:
+        selector.close()
+        if process.stdout:
+            process.stdout.close()
+        process.stderr.close()
+        pbar.close()
+        if input_path:
+            advise_input(input_path, prefetch=False)
+
+def remove_partial_output(output_path):
+    # Just try the unlink: a separate exists() check is an extra syscall
+    try: os.remove(output_path)
+    except OSError: pass
+
+def build_video_cmd(input_path, output_path, encoder):
+    # encoder: (name, options) to transcode with, or None to remux (stream copy)
+    if encoder is None:
+        codec_args = VIDEO_REMUX_ARGS
+    else:
+        name, options = encoder
+        codec_args = ('-c:v', name, *options, *VIDEO_TRANSCODE_ARGS)
+
+    return (*FFMPEG_CMD_PREFIX, '-i', input_path, *VIDEO_MAP_ARGS, *codec_args, *VIDEO_OUTPUT_ARGS, output_path)
+
+def sanitize_video(input_path, output_path, pbar_pos=0):
+    try:
+        duration, video_codec, audio_codec = probe_media(input_path)
+        if duration and duration > MAX_MEDIA_DURATION:
+            log_event("SECURITY", f"Video duration exceeds limit ({duration:.0f}s)", {"file": input_path})
+            return False
 
-        start_time = time.time()
-        time_pattern = re.compile(r"time=(\d+):(\d+):(\d+\.\d+)")
-        
         if duration:
             # Allow for slow processing (up to 5x real-time in worst case, or at least 1 hour)
             timeout_limit = max(3600, duration * 5)
         else:
             timeout_limit = 3600 # Default 1 hour if duration unknown
 
-        while True:
-            # Check timeout
-            if time.time() - start_time > timeout_limit:
-                process.kill()
-                if pbar: pbar.close()
+        filename = os.path.basename(input_path)
+        desc = f"Video ({filename[:10]}...)"
+
+        # Attempts in order: (label, encoder). Each later one is a fallback for the previous.
+        attempts = []
+
+        # Fast path (Level 1 Remux): streams are already H.264/AAC, so a stream copy
+        # with metadata/chapters dropped is enough. Otherwise fully transcode.
+        if FAST_COPY and video_codec == 'h264' and audio_codec in ('aac', None):
+            attempts.append(('remux', None))
+
+        encoder = get_video_encoder()
+        attempts.append((encoder[0], encoder))
+        if encoder is not SOFTWARE_ENCODER:
+            # A hardware encoder can still reject a particular input (size, profile, session limits)
+            attempts.append((SOFTWARE_ENCODER[0], SOFTWARE_ENCODER))
+
+        for i, (label, encoder) in enumerate(attempts):
+            cmd = build_video_cmd(input_path, output_path, encoder)
+            returncode, err_output = run_ffmpeg(cmd, duration, timeout_limit, desc, pbar_pos, input_path)
+
+            if returncode is None:
                 log_event("SECURITY", f"Video processing timed out ({timeout_limit}s limit) - Cleaning up", {"file": input_path})
-                if os.path.exists(output_path):
-                    try: os.remove(output_path)
-                    except: pass
+                remove_partial_output(output_path)
                 return False
 
-            # Read from the wrapper. 
-            # Note: ffmpeg uses \r for updates. TextIOWrapper with newline="" handles this,
-            # but readline might still wait for \n in some implementations. 
-            # However, ffmpeg usually outputs \n periodically or at end.
-            # To be safe for \r, we can read char by char or use a loop.
-            # But standard iteration often works with universal newlines.
-            # Let's try reading a chunk or line.
-            
-            # Simple fallback: readline with universal newline support usually handles \r as a line end
-            line = stderr_reader.readline()
-            
-            if not line and process.poll() is not None:
-                break
-            
-            if line:
-                match = time_pattern.search(line)
-                if match and pbar and duration:
-                    h, m, s = match.groups()
-                    current_seconds = int(h) * 3600 + int(m) * 60 + float(s)
-                    pbar.n = min(current_seconds, duration)
-                    pbar.refresh()
-
-        if pbar: pbar.close()
-        
-        if process.returncode == 0:
-            log_event("SUCCESS", "Video sanitized successfully", {"input": input_path, "output": output_path})
-            return True
-        else:
-            # Consume remaining stderr if any
-            err_output = process.stderr.read().decode('utf-8', errors='ignore')
-            log_event("ERROR", f"Video sanitization failed: {err_output}", {"file": input_path})
-            return False
+            if returncode == 0:
+                log_event("SUCCESS", f"Video sanitized successfully ({label})", {"input": input_path, "output": output_path})
+                return True
+
+            if i + 1 < len(attempts):
+                log_event("WARNING", f"{label} failed - Falling back to {attempts[i + 1][0]}", {"file": input_path})
+                remove_partial_output(output_path)
+
+        log_event("ERROR", f"Video sanitization failed: {err_output}", {"file": input_path})
+        return False
 
     except Exception as e:
         log_event("ERROR", f"Video unexpected error: {e}", {"file": input_path})
         return False
 
+def build_audio_cmd(input_path, output_path, remux):
+    codec_args = AUDIO_REMUX_ARGS if remux else AUDIO_TRANSCODE_ARGS
+    return (*FFMPEG_CMD_PREFIX, '-i', input_path, *AUDIO_MAP_ARGS, *codec_args, *AUDIO_OUTPUT_ARGS, output_path)
+
 def sanitize_audio(input_path, output_path, pbar_pos=0):
     try:
-        cmd = [
-            'ffmpeg', '-y', '-nostdin',
-            '-i', input_path,
-            '-map', '0:a:0',       # Pick first audio stream
-            '-map_metadata', '-1', # Strip metadata
-            '-c:a', 'aac',         # Re-encode Audio to AAC
-            '-b:a', '192k',        # Good quality bitrate
-            output_path
-        ]
-        
-        duration = get_video_duration(input_path)
-        # Read as binary
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stderr_reader = io.TextIOWrapper(process.stderr, encoding='utf-8', errors='ignore', newline="")
-        
-        filename = os.path.basename(input_path)
-        pbar = None
-        if duration:
-            pbar = tqdm(total=duration, unit="s", desc=f"Audio ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
-        else:
-            pbar = tqdm(unit="s", desc=f"Audio ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
+        duration, _, audio_codec = probe_media(input_path)
+        if duration and duration > MAX_MEDIA_DURATION:
+            log_event("SECURITY", f"Audio duration exceeds limit ({duration:.0f}s)", {"file": input_path})
+            return False
 
-        start_time = time.time()
-        time_pattern = re.compile(r"time=(\d+):(\d+):(\d+\.\d+)")
-        
         if duration:
             timeout_limit = max(3600, duration * 5)
         else:
             timeout_limit = 3600
 
-        while True:
-            # Check timeout
-            if time.time() - start_time > timeout_limit:
-                process.kill()
-                if pbar: pbar.close()
+        filename = os.path.basename(input_path)
+        desc = f"Audio ({filename[:10]}...)"
+
+        # Fast path (Level 1 Remux): AAC sources only need a rewrap, not a decode/encode
+        if FAST_COPY and audio_codec == 'aac':
+            cmd = build_audio_cmd(input_path, output_path, remux=True)
+            returncode, err_output = run_ffmpeg(cmd, duration, timeout_limit, desc, pbar_pos, input_path)
+
+            if returncode is None:
                 log_event("SECURITY", f"Audio processing timed out ({timeout_limit}s limit) - Cleaning up", {"file": input_path})
-                if os.path.exists(output_path):
-                    try: os.remove(output_path)
-                    except: pass
+                remove_partial_output(output_path)
                 return False
 
-            line = stderr_reader.readline()
-            if not line and process.poll() is not None:
-                break
-            
-            if line:
-                match = time_pattern.search(line)
-                if match and pbar and duration:
-                    h, m, s = match.groups()
-                    current_seconds = int(h) * 3600 + int(m) * 60 + float(s)
-                    pbar.n = min(current_seconds, duration)
-                    pbar.refresh()
-
-        if pbar: pbar.close()
-        
-        if process.returncode == 0:
+            if returncode == 0:
+                log_event("SUCCESS", "Audio sanitized successfully (remux)", {"input": input_path, "output": output_path})
+                return True
+
+            log_event("WARNING", "Remux failed - Falling back to transcode", {"file": input_path})
+            remove_partial_output(output_path)
+
+        cmd = build_audio_cmd(input_path, output_path, remux=False)
+        returncode, err_output = run_ffmpeg(cmd, duration, timeout_limit, desc, pbar_pos, input_path)
+
+        if returncode is None:
+            log_event("SECURITY", f"Audio processing timed out ({timeout_limit}s limit) - Cleaning up", {"file": input_path})
+            remove_partial_output(output_path)
+            return False
+
+        if returncode == 0:
             log_event("SUCCESS", "Audio sanitized successfully", {"input": input_path, "output": output_path})
             return True
         else:
-            err_output = process.stderr.read().decode('utf-8', errors='ignore')
             log_event("ERROR", f"Audio sanitization failed: {err_output}", {"file": input_path})
             return False
 
@@ -303,77 +934,131 @@ def sanitize_audio(input_path, output_path, pbar_pos=0):
         log_event("ERROR", f"Audio unexpected error: {e}", {"file": input_path})
         return False
 
+def sanitize_gif_gifsicle(input_path, output_path):
+    # gifsicle parses the GIF and writes a new one containing only image data and timing,
+    # without ffmpeg's full decode -> re-quantize -> re-encode round trip.
+    cmd = [
+        GIFSICLE,
+        '--no-comments',
+        '--no-names',
+        '--no-extensions',
+        '--no-app-extensions',
+        input_path,
+        '-o', output_path
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+    except subprocess.TimeoutExpired:
+        log_event("WARNING", "gifsicle timed out - Falling back to FFmpeg", {"file": input_path})
+        return False
+
+    if result.returncode != 0:
+        err_output = result.stderr.decode('utf-8', errors='ignore')
+        log_event("WARNING", f"gifsicle failed - Falling back to FFmpeg: {err_output}", {"file": input_path})
+        return False
+    return True
+
 def sanitize_gif(input_path, output_path, pbar_pos=0):
+    # output_path ends in .mp4 when GIF_TO_MP4 is set (see process_file)
+    palette_path = None
     try:
-        cmd = [
-            'ffmpeg', '-y', '-nostdin',
-            '-i', input_path,
-            '-map', '0:v:0',
-            '-map_metadata', '-1',
-            '-f', 'gif',
-            output_path
-        ]
-        
+        # Fast path (Level 1 Remux): gifsicle rewrites the container but keeps the original
+        # LZW-coded frames, so like the other remux paths it is opt-in
+        if FAST_COPY and not GIF_TO_MP4 and GIFSICLE and sanitize_gif_gifsicle(input_path, output_path):
+            log_event("SUCCESS", "GIF sanitized successfully (gifsicle)", {"input": input_path, "output": output_path})
+            return True
+
+        # One 300s budget shared by both passes of the palette path
+        deadline = time.monotonic() + 300
+
         # GIFs can be treated as videos
-        duration = get_video_duration(input_path)
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stderr_reader = io.TextIOWrapper(process.stderr, encoding='utf-8', errors='ignore', newline="")
-        
+        duration, _, _ = probe_media(input_path)
         filename = os.path.basename(input_path)
-        pbar = None
-        if duration:
-            pbar = tqdm(total=duration, unit="s", desc=f"GIF ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
-        else:
-            pbar = tqdm(unit="s", desc=f"GIF ({filename[:10]}...)", ncols=80, leave=True, position=pbar_pos)
+        desc = f"GIF ({filename[:10]}...)"
 
-        start_time = time.time()
-        time_pattern = re.compile(r"time=(\d+):(\d+):(\d+\.\d+)")
-        
-        while True:
-             if time.time() - start_time > 300:
-                process.kill()
-                if pbar: pbar.close()
+        if GIF_TO_MP4:
+            cmd = (*FFMPEG_CMD_PREFIX, *GIF_INPUT_ARGS, '-i', input_path, *GIF_MP4_ARGS, output_path)
+        else:
+            # Pass 1: build an optimized palette, so pass 2 doesn't fall back to the generic
+            # 256-color one (bigger files, worse dithering)
+            fd, palette_path = tempfile.mkstemp(suffix='.png')
+            os.close(fd)
+            cmd = (*FFMPEG_CMD_PREFIX, *GIF_INPUT_ARGS, '-i', input_path, *GIF_PALETTE_ARGS, palette_path)
+            # Transient bar: pass 2 draws the one that stays, on the same row
+            returncode, err_output = run_ffmpeg(cmd, duration, max(0, deadline - time.monotonic()), desc, pbar_pos, input_path, leave=False)
+            if returncode is None:
                 log_event("SECURITY", "GIF processing timed out - Cleaning up", {"file": input_path})
-                if os.path.exists(output_path):
-                    try: os.remove(output_path)
-                    except: pass
+                return False
+            if returncode != 0:
+                log_event("ERROR", f"GIF sanitization failed: {err_output}", {"file": input_path})
                 return False
 
-             line = stderr_reader.readline()
-             if not line and process.poll() is not None:
-                break
-            
-             if line:
-                match = time_pattern.search(line)
-                if match and pbar and duration:
-                    h, m, s = match.groups()
-                    current_seconds = int(h) * 3600 + int(m) * 60 + float(s)
-                    pbar.n = min(current_seconds, duration)
-                    pbar.refresh()
-        
-        if pbar: pbar.close()
+            cmd = (*FFMPEG_CMD_PREFIX, *GIF_INPUT_ARGS, '-i', input_path, '-i', palette_path, *GIF_OUTPUT_ARGS, output_path)
+
+        returncode, err_output = run_ffmpeg(cmd, duration, max(0, deadline - time.monotonic()), desc, pbar_pos, input_path)
+
+        if returncode is None:
+            log_event("SECURITY", "GIF processing timed out - Cleaning up", {"file": input_path})
+            remove_partial_output(output_path)
+            return False
 
-        if process.returncode == 0:
+        if returncode == 0:
             log_event("SUCCESS", "GIF sanitized successfully", {"input": input_path, "output": output_path})
             return True
         else:
-             log_event("ERROR", f"GIF sanitization failed", {"file": input_path})
+             log_event("ERROR", f"GIF sanitization failed: {err_output}", {"file": input_path})
              return False
 
     except Exception as e:
         log_event("ERROR", f"GIF unexpected error: {e}", {"file": input_path})
         return False
+    finally:
+        if palette_path:
+            remove_partial_output(palette_path)
 
-def process_file(rel_path, pbar_pos=0):
-    input_path = os.path.join(INPUT_DIR, rel_path)
-    
-    if os.path.isdir(input_path):
-        return
+def init_worker(slots):
+    # Runs once per pool thread; next() on an itertools count/cycle is atomic under the GIL,
+    # so no lock needed. Each pool gets its own slot source so the two pools' bars don't overlap.
+    _worker_local.slot = next(slots)
 
+def record_stats(rel_path, orig_size, outcome, cat=None, reason=None, output_size=None, cache_row=None):
+    # Applies one file's whole contribution to stats under a single lock acquisition.
+    # outcome: "success", "skipped" (resource limit), "ignored" (non-media) or "failed"
     with stats_lock:
         stats["total"] += 1
-        orig_size = os.path.getsize(input_path)
         stats["original_size"] += orig_size
+        if cat:
+            stats["types"][cat] += 1
+        if outcome == "success":
+            stats["success"] += 1
+            if output_size is not None:
+                stats["sanitized_size"] += output_size
+            if cache_row:
+                _cache_updates.append(cache_row)
+        elif outcome == "ignored":
+            stats["ignored"] += 1
+            stats["ignored_files"].append(rel_path)
+        else:
+            if outcome == "skipped":
+                stats["skipped"] += 1
+            stats["failed"].append((rel_path, reason))
+
+def process_file(rel_path, orig_size, mtime, mime_type=None):
+    input_path = os.path.join(INPUT_DIR, rel_path)
+    pbar_pos = getattr(_worker_local, 'slot', 0)
+
+    # 0. Unchanged since a previous successful run (and its output is still there)
+    cached = cached_entry(rel_path, orig_size, mtime)
+    if cached:
+        output_path, cat = cached
+        try:
+            output_size = os.stat(output_path).st_size
+        except OSError:
+            output_size = None
+        if output_size is not None:
+            log_event("SKIP", "Unchanged since last run", {"file": rel_path})
+            record_stats(rel_path, orig_size, "success", cat, output_size=output_size)
+            return
 
     log_event("INFO", "Processing file", {"file": rel_path})
     
@@ -381,18 +1066,16 @@ def process_file(rel_path, pbar_pos=0):
     if orig_size > MAX_FILE_SIZE_BYTES:
         msg = f"File size exceeds limit ({format_size(orig_size)})"
         log_event("SECURITY", msg, {"file": rel_path})
-        with stats_lock:
-            stats["skipped"] += 1
-            stats["failed"].append((rel_path, msg))
+        record_stats(rel_path, orig_size, "skipped", reason=msg)
         return
 
-    # 2. Diagnosis / Type Check
-    mime_type = get_mime_type(input_path)
+    # 2. Diagnosis / Type Check (detect_mime_types may have done it already)
+    if not mime_type:
+        mime_type = get_mime_type(input_path)
     if not mime_type:
         msg = "Could not detect MIME type"
         log_event("ERROR", msg, {"file": rel_path})
-        with stats_lock:
-            stats["failed"].append((rel_path, msg))
+        record_stats(rel_path, orig_size, "failed", reason=msg)
         return
 
     # Categorize type for stats
@@ -401,20 +1084,18 @@ def process_file(rel_path, pbar_pos=0):
     elif mime_type.startswith('video/'): cat = "video"
     elif mime_type.startswith('audio/'): cat = "audio"
     elif mime_type.startswith('image/'): cat = "image"
-    
-    with stats_lock:
-        stats["types"][cat] += 1
 
-    # 3. Prepare Output Path
-    rel_dir = os.path.dirname(rel_path)
-    base_name = os.path.basename(rel_path)
+    # 3. Prepare Output Path (split the relative path once and reuse the parts)
+    rel_dir, base_name = os.path.split(rel_path)
+    stem, ext = os.path.splitext(base_name)
+    ext = ext.lower()
     
-    safe_base = re.sub(r'[^a-zA-Z0-9._-]', '_', os.path.splitext(base_name)[0])
+    safe_base = UNSAFE_NAME_RE.sub('_', stem)
     if not safe_base:
         safe_base = "sanitized_" + str(uuid.uuid4())[:8]
     
+    # Already created by main()
     target_dir = os.path.join(OUTPUT_DIR, rel_dir)
-    os.makedirs(target_dir, exist_ok=True)
     
     success = False
     output_path = None
@@ -422,7 +1103,7 @@ def process_file(rel_path, pbar_pos=0):
 
     try:
         if cat == 'gif':
-             output_path = os.path.join(target_dir, f"{safe_base}.gif")
+             output_path = os.path.join(target_dir, f"{safe_base}.mp4" if GIF_TO_MP4 else f"{safe_base}.gif")
              success = sanitize_gif(input_path, output_path, pbar_pos)
         
         elif cat == 'video':
@@ -430,8 +1111,7 @@ def process_file(rel_path, pbar_pos=0):
             success = sanitize_video(input_path, output_path, pbar_pos)
             
         elif cat == 'image':
-            ext = os.path.splitext(base_name)[1].lower()
-            if not ext in ['.jpg', '.jpeg', '.png', '.webp', '.bmp']:
+            if ext not in SAFE_IMAGE_EXTS:
                  ext = '.png'
             output_path = os.path.join(target_dir, f"{safe_base}{ext}")
             success = sanitize_image(input_path, output_path)
@@ -444,7 +1124,7 @@ def process_file(rel_path, pbar_pos=0):
             error_reason = f"Unsupported file type ({mime_type})"
             log_event("WARNING", error_reason, {"file": rel_path})
             success = False
-    except Image.DecompressionBombError:
+    except load_pil().DecompressionBombError:
         error_reason = "Decompression bomb detected"
         log_event("SECURITY", error_reason, {"file": rel_path})
         success = False
@@ -454,20 +1134,46 @@ def process_file(rel_path, pbar_pos=0):
         success = False
 
     if success:
-        with stats_lock:
-            stats["success"] += 1
-            if output_path and os.path.exists(output_path):
-                stats["sanitized_size"] += os.path.getsize(output_path)
+        # One stat for the output (not exists() + getsize()), done before taking the lock
+        try:
+            output_size = os.stat(output_path).st_size if output_path else None
+        except OSError:
+            output_size = None
+        cache_row = (rel_path, orig_size, mtime, output_path, cat) if output_size is not None else None
+        record_stats(rel_path, orig_size, "success", cat, output_size=output_size, cache_row=cache_row)
     elif cat == "other":
-        with stats_lock:
-            stats["ignored"] += 1
-            stats["ignored_files"].append(rel_path)
+        record_stats(rel_path, orig_size, "ignored", cat)
     else:
-        with stats_lock:
-            stats["failed"].append((rel_path, error_reason))
+        record_stats(rel_path, orig_size, "failed", cat, reason=error_reason)
+
+def scan_input_dir(base_dir):
+    # Recursive walk via os.scandir: DirEntry caches the file type, and stat() is done
+    # once here so process_file doesn't need another getsize() call.
+    # Like os.walk, hidden files are skipped and symlinked directories are not followed.
+    # The stack carries each directory's relative prefix, so no per-file relpath() is needed.
+    tasks = []
+    stack = [(base_dir, '')]
+    while stack:
+        current, rel_dir = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    try:
+                        rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append((entry.path, rel_path))
+                        elif entry.is_file() and not entry.name.startswith('.'):
+                            st = entry.stat()
+                            tasks.append((rel_path, st.st_size, st.st_mtime))
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return tasks
 
 def main():
-    log_event("SYSTEM", f"Sanitizer started (Max Workers: {MAX_WORKERS})")
+    open_log()
+    log_event("SYSTEM", f"Sanitizer started (Workers: {MAX_WORKERS} image, {AV_WORKERS} media)")
     stats["start_time"] = time.time()
     
     if not os.path.exists(INPUT_DIR):
@@ -476,35 +1182,65 @@ def main():
 
     task_files = []
     try:
-        for root, dirs, files in os.walk(INPUT_DIR):
-            for f in files:
-                if not f.startswith('.'):
-                    rel_path = os.path.relpath(os.path.join(root, f), INPUT_DIR)
-                    task_files.append(rel_path)
+        # (rel_path, size, mtime) tuples; these come from the scandir entries so files aren't stat'ed twice
+        task_files = scan_input_dir(INPUT_DIR)
         
         if not task_files:
             log_event("INFO", "No files found in input directory")
             return
         
-        task_files.sort()
+        # Largest first (LPT scheduling): big videos start early instead of leaving one
+        # worker busy long after the others have drained the small files
+        task_files.sort(key=lambda task: (-task[1], task[0]))
 
-        slot_queue = queue.Queue()
-        for i in range(MAX_WORKERS):
-            slot_queue.put(i)
+        # Create every output directory once up front instead of a makedirs() per file
+        for rel_dir in sorted({os.path.dirname(rel_path) for rel_path, _, _ in task_files}):
+            try:
+                os.makedirs(os.path.join(OUTPUT_DIR, rel_dir), exist_ok=True)
+            except OSError as e:
+                log_event("ERROR", f"Could not create output directory: {e}", {"file": rel_dir})
 
-        def worker_wrapper(rel_path):
-             slot = slot_queue.get()
-             try:
-                 process_file(rel_path, pbar_pos=slot)
-             finally:
-                 slot_queue.put(slot)
+        _cache.update(load_cache())
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            executor.map(worker_wrapper, task_files)
+        mime_types = {}
+        if TRUST_EXT:
+            for rel_path, _, _ in task_files:
+                mime_type = EXT_MIME.get(os.path.splitext(rel_path)[1].lower())
+                if mime_type:
+                    mime_types[rel_path] = mime_type
+        # Inputs that will be skipped as unchanged don't need a MIME type
+        mime_types.update(detect_mime_types([rel_path for rel_path, size, mtime in task_files
+                                             if rel_path not in mime_types and not cached_entry(rel_path, size, mtime)]))
+
+        # Two pools: many cheap image decodes run in parallel, while only a few
+        # (internally multi-threaded) ffmpeg jobs run at once. Media workers take
+        # bar slots 0..AV_WORKERS-1, image workers share IMAGE_BAR_SLOTS rows below them.
+        av_pool = concurrent.futures.ThreadPoolExecutor(max_workers=AV_WORKERS, initializer=init_worker,
+                                                        initargs=(itertools.count(),))
+        image_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker,
+                                                           initargs=(itertools.cycle(range(AV_WORKERS, AV_WORKERS + IMAGE_BAR_SLOTS)),))
+        with av_pool, image_pool:
+            futures = []
+            for rel_path, size, mtime in task_files:
+                mime_type = mime_types.get(rel_path)
+                if mime_type:
+                    is_av = mime_type == 'image/gif' or mime_type.startswith(('video/', 'audio/'))
+                else:
+                    is_av = os.path.splitext(rel_path)[1].lower() in AV_EXTS
+                pool = av_pool if is_av else image_pool
+                futures.append(pool.submit(process_file, rel_path, size, mtime, mime_type))
+            # Overall bar below the per-worker ffmpeg bars. Advanced in completion order
+            # (not executor.map's submission order) so one long video doesn't stall it.
+            # thread_map isn't used because it can't pass the pool initializer.
+            for _ in tqdm(concurrent.futures.as_completed(futures), total=len(futures),
+                          desc="Files", unit="file", ncols=80, position=AV_WORKERS + IMAGE_BAR_SLOTS):
+                pass
 
     except Exception as e:
         log_event("ERROR", f"Main loop failed: {e}")
 
+    save_cache(_cache_updates)
+
     # Final Report
     elapsed = time.time() - stats["start_time"]
     mins, secs = divmod(int(elapsed), 60)